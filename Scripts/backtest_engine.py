@@ -0,0 +1,506 @@
+"""
+backtest_engine.py
+
+Native NumPy/Numba target-weight backtest engine (alternative to vectorbt).
+
+Simulates the portfolio run_backtest.py builds with vectorbt:
+    Portfolio.from_orders(size_type="targetpercent", cash_sharing=True,
+                          call_seq="auto", fees=FEES, init_cash=INIT_CASH)
+
+Rules (same as vectorbt):
+- Orders execute at the close; NaN weight = no order, NaN price = no order
+- Group value is fixed at the start of each bar (cash + positions at close)
+- Target size = weight * group value / price; order = target - position
+- Orders in a bar run sells first (sorted by approximate order value)
+- Buys are partially filled if cash is short; fees = |size| * price * FEES
+- Trades are exit trades: every reducing order closes (part of) a trade
+
+Outputs: equity curve, order records, trade records and summary stats
+(vectorbt's stats() schema; the benchmark needs ticker prices and is left
+to run_backtest.py).
+
+simulate_stacked_nb runs many weight matrices against the same prices in
+parallel (one stacked backtest for parameter sweeps, see sweep.py).
+"""
+
+import numpy as np
+import pandas as pd
+from numba import njit, prange
+
+# -----------------------------
+# Configurable parameters
+# -----------------------------
+INIT_CASH = 1_000_000
+FEES = 0.0012  # 0.12% cost
+YEAR_DAYS = 365  # annualization, as vectorbt's year_freq="365 days"
+
+REL_TOL = 1e-9
+ABS_TOL = 1e-12
+
+ORDER_FIELDS = ["idx", "col", "size", "price", "fees", "side"]
+TRADE_FIELDS = [
+    "col",
+    "size",
+    "entry_idx",
+    "entry_price",
+    "entry_fees",
+    "exit_idx",
+    "exit_price",
+    "exit_fees",
+    "pnl",
+    "return",
+    "direction",
+    "status",
+]
+BUY, SELL = 0, 1
+LONG, SHORT = 0, 1
+OPEN, CLOSED = 0, 1
+
+
+# -----------------------------
+# Float helpers (vectorbt tolerances)
+# -----------------------------
+@njit(cache=True)
+def is_close(a, b):
+    if a == b:
+        return True
+    return abs(a - b) <= max(REL_TOL * max(abs(a), abs(b)), ABS_TOL)
+
+
+@njit(cache=True)
+def add(a, b):
+    """a + b, snapped to exactly 0.0 when the two cancel out."""
+    if np.sign(a) != np.sign(b) and is_close(abs(a), abs(b)):
+        return 0.0
+    return a + b
+
+
+# -----------------------------
+# Simulation
+# -----------------------------
+@njit(cache=True)
+def _simulate(close, weights, init_cash, fees, value_out, orders):
+    """
+    Cash-sharing target-percent simulation of one portfolio. Fills value_out
+    (value per bar) and orders (one row per order); returns the order count.
+    """
+    n_dates, n_cols = close.shape
+    position = np.zeros(n_cols)
+    val_price = np.full(n_cols, np.nan)
+    order_value = np.empty(n_cols)
+    n_orders = 0
+
+    cash = float(init_cash)
+
+    for i in range(n_dates):
+        for col in range(n_cols):
+            if not np.isnan(close[i, col]):
+                val_price[col] = close[i, col]
+
+        value = cash
+        for col in range(n_cols):
+            if position[col] != 0:
+                value += position[col] * val_price[col]
+
+        # Sells first: sort by approximate order value. A column with no
+        # weight or no price yet cannot trade and goes last (as vectorbt's NaN)
+        n_active = 0
+        for col in range(n_cols):
+            if np.isfinite(weights[i, col]) and np.isfinite(val_price[col]):
+                order_value[col] = weights[i, col] * value - position[col] * val_price[col]
+                n_active += 1
+            else:
+                order_value[col] = np.inf
+        if n_active == 0:
+            value_out[i] = value
+            continue
+        call_seq = np.argsort(order_value, kind="mergesort")
+
+        for k in range(n_active):
+            col = call_seq[k]
+            price = close[i, col]
+            if np.isnan(price) or value <= 0:
+                continue
+
+            size = weights[i, col] * value / val_price[col] - position[col]
+
+            if size > 0:
+                if is_close(cash, 0.0) or is_close(size, 0.0):
+                    continue
+                req_cash = size * price
+                total_req = req_cash + req_cash * fees
+                if total_req <= cash or is_close(total_req, cash):
+                    fill, fee, spent = size, req_cash * fees, total_req
+                else:
+                    max_req = cash / (1 + fees)
+                    fill, fee, spent = max_req / price, cash - max_req, cash
+                cash = add(cash, -spent)
+                position[col] = add(position[col], fill)
+                side = BUY
+            else:
+                fill = -size
+                if is_close(fill, 0.0):
+                    continue
+                acq = fill * price
+                fee = acq * fees
+                cash = cash + (acq - fee)
+                position[col] = add(position[col], -fill)
+                side = SELL
+
+            if is_close(position[col], 0.0):
+                position[col] = 0.0
+
+            orders[n_orders, 0] = i
+            orders[n_orders, 1] = col
+            orders[n_orders, 2] = fill
+            orders[n_orders, 3] = price
+            orders[n_orders, 4] = fee
+            orders[n_orders, 5] = side
+            n_orders += 1
+
+        value_out[i] = cash
+        for col in range(n_cols):
+            if position[col] != 0:
+                value_out[i] += position[col] * val_price[col]
+
+    return n_orders
+
+
+@njit(cache=True)
+def simulate_nb(close, weights, init_cash, fees):
+    """One portfolio. Returns (value per bar, order records as a 2D float array)."""
+    value = np.empty(close.shape[0])
+    orders = np.empty((np.sum(~np.isnan(weights)), 6))
+    n_orders = _simulate(close, weights, init_cash, fees, value, orders)
+    return value, orders[:n_orders]
+
+
+@njit(cache=True, parallel=True)
+def simulate_stacked_nb(close, weights, init_cash, fees):
+    """
+    Many portfolios on the same prices, run in parallel. weights has shape
+    (n_portfolios, dates, slots); prices are shared, not tiled. fees holds
+    one fee rate per portfolio.
+
+    Returns (value per portfolio and bar, order records of all portfolios,
+    order offsets): orders of portfolio p are orders[offsets[p]:offsets[p + 1]].
+    """
+    n_portfolios = weights.shape[0]
+    capacity = np.zeros(n_portfolios + 1, dtype=np.int64)
+    for p in range(n_portfolios):
+        capacity[p + 1] = capacity[p] + np.sum(~np.isnan(weights[p]))
+
+    value = np.empty((n_portfolios, close.shape[0]))
+    orders = np.empty((capacity[-1], 6))
+    counts = np.zeros(n_portfolios, dtype=np.int64)
+
+    for p in prange(n_portfolios):
+        counts[p] = _simulate(
+            close, weights[p], init_cash, fees[p], value[p],
+            orders[capacity[p]:capacity[p + 1]],
+        )
+
+    # Compact the per-portfolio slices
+    offsets = np.zeros(n_portfolios + 1, dtype=np.int64)
+    for p in range(n_portfolios):
+        offsets[p + 1] = offsets[p] + counts[p]
+    packed = np.empty((offsets[-1], 6))
+    for p in range(n_portfolios):
+        packed[offsets[p]:offsets[p + 1]] = orders[capacity[p]:capacity[p] + counts[p]]
+
+    return value, packed, offsets
+
+
+@njit(cache=True)
+def _trade_record(out, t, col, size, entry_idx, entry_price, entry_fees,
+                  exit_idx, exit_price, exit_fees, direction, status):
+    pnl = size * (exit_price - entry_price) - entry_fees - exit_fees
+    if direction == SHORT:
+        pnl = size * (entry_price - exit_price) - entry_fees - exit_fees
+    out[t, 0] = col
+    out[t, 1] = size
+    out[t, 2] = entry_idx
+    out[t, 3] = entry_price
+    out[t, 4] = entry_fees
+    out[t, 5] = exit_idx
+    out[t, 6] = exit_price
+    out[t, 7] = exit_fees
+    out[t, 8] = pnl
+    out[t, 9] = pnl / (size * entry_price)
+    out[t, 10] = direction
+    out[t, 11] = status
+
+
+@njit(cache=True)
+def exit_trades_nb(orders, last_close, last_idx):
+    """Aggregate order records (sorted by column, then time) into exit trades."""
+    out = np.empty((len(orders) + len(last_close), 12))
+    t = 0
+    n = len(orders)
+    k = 0
+
+    while k < n:
+        col = int(orders[k, 1])
+        in_position = False
+        direction = LONG
+        entry_idx = -1
+        size_sum = gross_sum = fees_sum = 0.0
+
+        while k < n and int(orders[k, 1]) == col:
+            i = int(orders[k, 0])
+            size, price, fee, side = orders[k, 2], orders[k, 3], orders[k, 4], orders[k, 5]
+            k += 1
+
+            if not in_position:
+                in_position = True
+                entry_idx = i
+                direction = LONG if side == BUY else SHORT
+                size_sum = gross_sum = fees_sum = 0.0
+
+            increases = (direction == LONG) == (side == BUY)
+            if increases:
+                size_sum += size
+                gross_sum += size * price
+                fees_sum += fee
+            elif size < size_sum or is_close(size, size_sum):
+                exit_size = size_sum if is_close(size, size_sum) else size
+                _trade_record(out, t, col, exit_size, entry_idx, gross_sum / size_sum,
+                              exit_size / size_sum * fees_sum, i, price, fee,
+                              direction, CLOSED)
+                t += 1
+                if is_close(size, size_sum):
+                    in_position = False
+                else:
+                    frac = (size_sum - size) / size_sum
+                    size_sum *= frac
+                    gross_sum *= frac
+                    fees_sum *= frac
+            else:
+                # Reversal: close the whole trade, open one the other way
+                close_fee = size_sum / size * fee
+                _trade_record(out, t, col, size_sum, entry_idx, gross_sum / size_sum,
+                              fees_sum, i, price, close_fee, direction, CLOSED)
+                t += 1
+                size_sum = size - size_sum
+                gross_sum = size_sum * price
+                fees_sum = fee - close_fee
+                entry_idx = i
+                direction = SHORT if direction == LONG else LONG
+
+        # Still open at the end: valued at the last bar's close
+        if in_position and not is_close(size_sum, 0.0):
+            _trade_record(out, t, col, size_sum, entry_idx, gross_sum / size_sum,
+                          fees_sum, last_idx, last_close[col], 0.0, direction, OPEN)
+            t += 1
+
+    return out[:t]
+
+
+# -----------------------------
+# Portfolio wrapper
+# -----------------------------
+def records_frame(records: np.ndarray, fields, int_fields) -> pd.DataFrame:
+    """2D float record array -> DataFrame, with int_fields cast to int64."""
+    return pd.DataFrame(
+        {
+            name: records[:, j].astype(np.int64) if name in int_fields else records[:, j]
+            for j, name in enumerate(fields)
+        }
+    )
+
+
+def last_closes(close: np.ndarray) -> np.ndarray:
+    """
+    Close of the last bar per column (values trades still open at the end).
+    Not forward-filled: like vectorbt, a trade left open in a column with no
+    last price gets a NaN exit price and PnL.
+    """
+    return np.array(close[-1], dtype=np.float64)
+
+
+class NativePortfolio:
+    """Result of a native backtest, indexed like the input matrices."""
+
+    def __init__(self, close: pd.DataFrame, weights: pd.DataFrame,
+                 init_cash=INIT_CASH, fees=FEES):
+        close_arr = np.ascontiguousarray(close.to_numpy(dtype=np.float64))
+        weight_arr = np.ascontiguousarray(weights.to_numpy(dtype=np.float64))
+
+        value, orders = simulate_nb(close_arr, weight_arr, float(init_cash), float(fees))
+        self._load(close.index, close.columns, value, orders, last_closes(close_arr), init_cash,
+                   close_arr)
+
+    @classmethod
+    def from_simulation(cls, index, columns, value, orders, last_close, init_cash=INIT_CASH,
+                        close=None):
+        """
+        Wrap the output of simulate_nb (e.g. one slice of a stacked run).
+        Without close, stats() reports Max Gross Exposure as NaN.
+        """
+        portfolio = cls.__new__(cls)
+        portfolio._load(index, columns, value, orders, last_close, init_cash, close)
+        return portfolio
+
+    def _load(self, index, columns, value, orders, last_close, init_cash, close):
+        self.index = index
+        self.columns = columns
+        self.init_cash = init_cash
+        self._value = value
+        self._close = close
+        self.orders = records_frame(orders, ORDER_FIELDS, ("idx", "col", "side"))
+
+        by_col = orders[np.argsort(orders[:, 1], kind="mergesort")]
+        trades = exit_trades_nb(by_col, last_close, len(index) - 1)
+        self.trade_records = records_frame(
+            trades, TRADE_FIELDS, ("col", "entry_idx", "exit_idx", "direction", "status")
+        )
+
+    def value(self) -> pd.Series:
+        return pd.Series(self._value, index=self.index, name="group")
+
+    def returns(self) -> np.ndarray:
+        prev = np.concatenate([[self.init_cash], self._value[:-1]])
+        return self._value / prev - 1
+
+    def gross_exposure(self) -> pd.Series:
+        return pd.Series(
+            gross_exposure(self._close, self.orders, self._value), index=self.index, name="group"
+        )
+
+    def stats(self) -> pd.Series:
+        return portfolio_stats(
+            self._value, self.returns(), self.trade_records, self.orders,
+            self.index, self.init_cash, self._close,
+        )
+
+
+# -----------------------------
+# Exposure
+# -----------------------------
+@njit(cache=True)
+def positions_nb(orders, n_dates, n_cols):
+    """
+    Positions after every bar and total short debt (short size x entry
+    price; partial covers release it pro rata) from time-ordered orders.
+    """
+    positions = np.zeros((n_dates, n_cols))
+    short_debt = np.zeros(n_dates)
+    position = np.zeros(n_cols)
+    debt = np.zeros(n_cols)
+    k = 0
+
+    for i in range(n_dates):
+        while k < len(orders) and int(orders[k, 0]) == i:
+            col = int(orders[k, 1])
+            size = orders[k, 2] if orders[k, 5] == BUY else -orders[k, 2]
+            short_before = max(-position[col], 0.0)
+            position[col] = add(position[col], size)
+            short_after = max(-position[col], 0.0)
+
+            if short_after > short_before:
+                debt[col] += (short_after - short_before) * orders[k, 3]
+            elif short_after < short_before:
+                debt[col] *= short_after / short_before
+            k += 1
+
+        positions[i] = position
+        short_debt[i] = debt.sum()
+    return positions, short_debt
+
+
+def gross_exposure(close, orders: pd.DataFrame, value) -> np.ndarray:
+    """
+    Daily gross exposure as vectorbt defines it: sum of |position value| /
+    (that sum + free cash), free cash being cash less twice the short debt.
+    orders: order records of either engine (idx, col, size, price, side).
+    """
+    close = np.asarray(close, dtype=np.float64)
+    value = np.asarray(value, dtype=np.float64)
+    n_dates, n_cols = close.shape
+
+    records = orders[["idx", "col", "size", "price", "fees", "side"]]
+    records = records.sort_values("idx", kind="mergesort").to_numpy(dtype=np.float64)
+    positions, short_debt = positions_nb(records, n_dates, n_cols)
+
+    marks = pd.DataFrame(close).ffill().fillna(0.0).to_numpy()
+    position_value = positions * marks
+    gross = np.abs(position_value).sum(axis=1)
+    cash = value - position_value.sum(axis=1)
+
+    denom = gross + cash - 2 * short_debt
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denom == 0, 0.0, gross / denom)
+
+
+# -----------------------------
+# Stats
+# -----------------------------
+def max_drawdown_duration(value) -> int:
+    """
+    Longest drawdown in bars, as vectorbt counts it: from the bar after the
+    peak up to (not including) the recovery bar, or through the last bar if
+    still under water.
+    """
+    at_high = np.flatnonzero(value >= np.maximum.accumulate(value))
+    durations = np.append(np.diff(at_high) - 1, len(value) - 1 - at_high[-1])
+    return int(durations.max())
+
+
+def portfolio_stats(value, returns, trades, orders, index, init_cash, close=None) -> pd.Series:
+    """
+    Summary stats with the same names, order and formulas as vectorbt's
+    stats(). The benchmark is NaN (it needs per-ticker prices, see
+    run_backtest.benchmark_return); Max Gross Exposure is NaN without close.
+    """
+    bar = pd.Timedelta(days=1)
+    drawdown = value / np.maximum.accumulate(value) - 1
+    max_dd = drawdown.min()
+
+    n = len(returns)
+    mean, std = returns.mean(), returns.std(ddof=1)
+    downside = np.sqrt(np.mean(np.minimum(returns, 0) ** 2))
+    ann_return = np.prod(1 + returns) ** (YEAR_DAYS / n) - 1
+    gains, losses = returns[returns > 0].sum(), -returns[returns < 0].sum()
+
+    closed = trades[trades["status"] == CLOSED]
+    winners = closed[closed["pnl"] > 0]
+    losers = closed[closed["pnl"] < 0]
+
+    def avg_duration(t):
+        return (t["exit_idx"] - t["entry_idx"]).mean() * bar
+
+    return pd.Series(
+        {
+            "Start": index[0],
+            "End": index[-1],
+            "Period": n * bar,
+            "Start Value": float(init_cash),
+            "End Value": value[-1],
+            "Total Return [%]": (value[-1] / init_cash - 1) * 100,
+            "Benchmark Return [%]": np.nan,
+            "Max Gross Exposure [%]": (
+                gross_exposure(close, orders, value).max() * 100 if close is not None else np.nan
+            ),
+            "Total Fees Paid": orders["fees"].sum(),
+            "Max Drawdown [%]": -max_dd * 100,
+            "Max Drawdown Duration": max_drawdown_duration(value) * bar,
+            "Total Trades": len(trades),
+            "Total Closed Trades": len(closed),
+            "Total Open Trades": len(trades) - len(closed),
+            "Open Trade PnL": trades.loc[trades["status"] == OPEN, "pnl"].sum(),
+            "Win Rate [%]": len(winners) / len(closed) * 100 if len(closed) else np.nan,
+            "Best Trade [%]": closed["return"].max() * 100,
+            "Worst Trade [%]": closed["return"].min() * 100,
+            "Avg Winning Trade [%]": winners["return"].mean() * 100,
+            "Avg Losing Trade [%]": losers["return"].mean() * 100,
+            "Avg Winning Trade Duration": avg_duration(winners),
+            "Avg Losing Trade Duration": avg_duration(losers),
+            "Profit Factor": winners["pnl"].sum() / -losers["pnl"].sum(),
+            "Expectancy": closed["pnl"].mean(),
+            "Sharpe Ratio": mean / std * np.sqrt(YEAR_DAYS),
+            "Calmar Ratio": ann_return / abs(max_dd),
+            "Omega Ratio": gains / losses,
+            "Sortino Ratio": mean / downside * np.sqrt(YEAR_DAYS),
+        },
+        name="group",
+    )
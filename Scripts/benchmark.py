@@ -0,0 +1,288 @@
+"""
+benchmark.py
+
+Benchmark harness for every pipeline stage, with regression tracking.
+
+For each dataset size (tickers x years; CONFIG.universe_size is overridden
+for the run) every stage runs in memory:
+    generate -> clean -> validate -> flag -> build -> backtest (native engine)
+and records wall time, peak RSS and rows/second.
+
+Rows are the universe-days a stage processes (its output for generate, raw
+rows for clean/validate, cleaned rows for the later stages). Peak RSS is the
+process high-water mark during the stage (Linux: /proc/self/status VmHWM,
+reset before every stage through /proc/self/clear_refs).
+
+Regression tracking (all files local, runs offline):
+- Every run is appended to BENCH_HISTORY (JSON list of runs)
+- --save-baseline stores the run as BENCH_BASELINE
+- Later runs flag stages slower (or using more memory) than the baseline
+  by more than TIME_TOLERANCE / RSS_TOLERANCE
+
+Outputs (in results/benchmarks/):
+- benchmark_history.json  : every run (timestamp, git commit, host, records)
+- benchmark_baseline.json : reference run for regression flags
+- benchmark_throughput    : the latest run as a table
+
+Usage:
+    python benchmark.py
+    python benchmark.py --sizes 50x1 500x1 5000x2 --save-baseline
+    python benchmark.py --fail-on-regression
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import platform
+import contextlib
+import subprocess
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from config import CONFIG
+from generate_data import START_DATE, generate_synthetic_dataset
+from clean_dataset import clean_dataset
+from check_date import validate_dataset
+from flag_dataset import flag_dataset
+from build_trading_dataset import build_trading_dataset
+from run_backtest import RESULT_DIR, run_backtest
+from storage import write_table
+
+# -----------------------------
+# Configurable parameters
+# -----------------------------
+# (tickers, years) per run
+DATASET_SIZES = [(50, 1), (500, 1), (1000, 1), (5000, 1), (10000, 1), (50, 10)]
+
+BENCH_DIR = os.path.join(RESULT_DIR, "benchmarks")
+BENCH_HISTORY = os.path.join(BENCH_DIR, "benchmark_history.json")
+BENCH_BASELINE = os.path.join(BENCH_DIR, "benchmark_baseline.json")
+
+TIME_TOLERANCE = 0.25  # flag stages more than 25% slower than baseline
+RSS_TOLERANCE = 0.25  # flag stages using more than 25% more peak memory
+MIN_SECONDS = 0.05  # stages faster than this are too noisy to flag on time
+
+RECORD_KEY = ["tickers", "years", "stage"]
+
+
+# -----------------------------
+# Memory helpers (Linux /proc)
+# -----------------------------
+def reset_peak_rss():
+    """Reset the process RSS high-water mark (no-op where unsupported)."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mb() -> float:
+    """Process RSS high-water mark in MB."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+
+    import resource
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# -----------------------------
+# One dataset size
+# -----------------------------
+def date_range(years: int):
+    start = pd.Timestamp(START_DATE)
+    end = start + pd.DateOffset(years=years) - pd.Timedelta(days=1)
+    return start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
+
+
+def run_stages(tickers: int, years: int) -> list:
+    """Time every stage for one dataset size. Returns one record per stage."""
+    start_date, end_date = date_range(years)
+    records = []
+
+    def timed(stage, rows, func, *args, **kwargs):
+        reset_peak_rss()
+        t0 = time.perf_counter()
+        # Stage banners would drown the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            out = func(*args, **kwargs)
+        seconds = time.perf_counter() - t0
+
+        rows = len(out) if rows is None else rows
+        records.append(
+            {
+                "tickers": tickers,
+                "years": years,
+                "stage": stage,
+                "rows": rows,
+                "seconds": seconds,
+                "peak_rss_mb": peak_rss_mb(),
+                "rows_per_sec": rows / seconds,
+            }
+        )
+        return out
+
+    with CONFIG.override(universe_size=tickers):
+        raw = timed("generate", None, generate_synthetic_dataset, start_date, end_date, save=False)
+        clean = timed("clean", len(raw), clean_dataset, raw, save=False)
+        timed("validate", len(raw), validate_dataset, raw)
+        flagged = timed("flag", len(clean), flag_dataset, clean, save=False)
+        prices, _, weights, slot_map = timed(
+            "build", len(flagged), build_trading_dataset, flagged, save=False
+        )
+        timed(
+            "backtest", len(flagged), run_backtest,
+            prices, weights, slot_map, save=False, engine="native",
+        )
+
+    return records
+
+
+# -----------------------------
+# History & regressions
+# -----------------------------
+def git_commit():
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, timeout=10
+        )
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_json(obj, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp, path)
+
+
+def find_regressions(table: pd.DataFrame, baseline: dict) -> pd.DataFrame:
+    """Stages slower or heavier than the baseline run beyond the tolerances."""
+    if not baseline:
+        return table.iloc[:0].assign(reason="")
+
+    base = pd.DataFrame(baseline["records"])[RECORD_KEY + ["seconds", "peak_rss_mb"]]
+    merged = table.merge(base, on=RECORD_KEY, suffixes=("", "_baseline"))
+
+    slower = (merged["seconds"] > merged["seconds_baseline"] * (1 + TIME_TOLERANCE)) & (
+        merged["seconds"] >= MIN_SECONDS
+    )
+    heavier = merged["peak_rss_mb"] > merged["peak_rss_mb_baseline"] * (1 + RSS_TOLERANCE)
+
+    reason = np.select([slower & heavier, slower, heavier], ["time+rss", "time", "rss"], "")
+    return merged.assign(reason=reason)[slower | heavier]
+
+
+# -----------------------------
+# Benchmark
+# -----------------------------
+def run_benchmark(sizes=DATASET_SIZES, save=True, save_baseline=False):
+    """
+    Run every stage for each (tickers, years) size, append the run to the
+    history and compare it with the baseline.
+    Returns (table, regressions).
+    """
+    print("\n==============================")
+    print(" PIPELINE BENCHMARK ")
+    print("==============================")
+    print(f"Sizes (tickers x years): {[f'{t}x{y}' for t, y in sizes]}\n")
+
+    records = []
+    for tickers, years in sizes:
+        records.extend(run_stages(tickers, years))
+        print(f"Finished {tickers} tickers x {years} years")
+
+    table = pd.DataFrame(records)
+
+    print("\nRows/second per stage:\n")
+    report = table.pivot_table(index=["tickers", "years"], columns="stage", values="rows_per_sec")
+    print(report[table["stage"].unique()].round(0).to_string())
+
+    print("\nPeak RSS (MB) per stage:\n")
+    report = table.pivot_table(index=["tickers", "years"], columns="stage", values="peak_rss_mb")
+    print(report[table["stage"].unique()].round(1).to_string())
+
+    run = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": git_commit(),
+        "host": socket.gethostname(),
+        "python": platform.python_version(),
+        "records": records,
+    }
+
+    regressions = find_regressions(table, load_json(BENCH_BASELINE, None))
+    print("\n==============================")
+    print(" REGRESSION CHECK ")
+    print("==============================")
+    if not os.path.exists(BENCH_BASELINE):
+        print("No baseline yet (run with --save-baseline to store one).")
+    elif regressions.empty:
+        print("No regressions against the baseline.")
+    else:
+        print("⚠️ WARNING: regressions against the baseline:\n")
+        print(
+            regressions[
+                RECORD_KEY
+                + ["seconds", "seconds_baseline", "peak_rss_mb", "peak_rss_mb_baseline", "reason"]
+            ].to_string(index=False)
+        )
+
+    if save:
+        history = load_json(BENCH_HISTORY, [])
+        history.append(run)
+        save_json(history, BENCH_HISTORY)
+        write_table(table, os.path.join(BENCH_DIR, "benchmark_throughput"))
+        print(f"\nAppended run to {BENCH_HISTORY}")
+    if save_baseline:
+        save_json(run, BENCH_BASELINE)
+        print(f"Saved baseline to {BENCH_BASELINE}")
+
+    return table, regressions
+
+
+def parse_size(text: str):
+    """'500x2' -> (500, 2); '500' -> (500, 1)."""
+    tickers, _, years = text.partition("x")
+    return int(tickers), int(years or 1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pipeline benchmark with regression tracking")
+    parser.add_argument(
+        "--sizes",
+        type=parse_size,
+        nargs="+",
+        default=DATASET_SIZES,
+        metavar="TICKERSxYEARS",
+    )
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument(
+        "--fail-on-regression", action="store_true", help="exit with status 1 on regressions"
+    )
+    args = parser.parse_args()
+
+    _, regressions = run_benchmark(args.sizes, save_baseline=args.save_baseline)
+    if args.fail_on_regression and not regressions.empty:
+        sys.exit(1)
@@ -1,83 +1,300 @@
 import pandas as pd
 import numpy as np
 import os
+import argparse
 
-INPUT_FILE = "data/synthetic_flagged.csv"
+from config import CONFIG
+from instrumentation import span
+from ranking import smallest_k
+from slot_layout import (
+    assign_slots,
+    events_to_weights,
+    slot_ticker_codes,
+    to_slot_matrix,
+    weights_to_events,
+)
+from storage import (
+    matrix_path,
+    read_matrix,
+    read_table,
+    remove_dataset,
+    storage_path,
+    write_matrix,
+    write_table,
+)
+
+INPUT_FILE = "data/synthetic_flagged"
 os.makedirs("data/trading", exist_ok=True)
-OUT_PRICES = "data/trading/trading_prices.csv"
-OUT_WEIGHTS = "data/trading/trading_weights.csv"
+OUT_PRICES = "data/trading/trading_prices"
+OUT_SIGNALS = "data/trading/trading_signals"
+OUT_WEIGHTS = "data/trading/trading_weights"
+OUT_SLOT_MAP = "data/trading/slot_map"
+OUT_WEIGHT_EVENTS = "data/trading/trading_weight_events"
+
+# "dense": dates x slots weight matrix (trading_weights)
+# "events": sparse (date, ticker, slot, weight) table of position changes only
+WEIGHTS_FORMAT = os.environ.get("PIPELINE_WEIGHTS_FORMAT", "dense")
+WEIGHTS_FORMATS = ("dense", "events")
 
 
-HOLDING_PERIOD = 3  # Rebalance every N days
-N_LONGS = 5  # Number of Long positions
-N_SHORTS = 5  # Number of Short positions
+# Strategy settings (defaults and environment overrides in config.py)
+HOLDING_PERIOD = CONFIG.holding_period  # Rebalance every N days (also used by run_backtest)
+N_LONGS = CONFIG.n_longs  # Number of Long positions
+N_SHORTS = CONFIG.n_shorts  # Number of Short positions
 
-LONG_ALLOCATION = 0.80  # Total capital for Longs (80%)
-SHORT_ALLOCATION = -0.20  # Total capital for Shorts (20%)
+LONG_ALLOCATION = CONFIG.long_allocation  # Total capital for Longs (80%)
+SHORT_ALLOCATION = CONFIG.short_allocation  # Total capital for Shorts (20%)
 
 LONG_W = LONG_ALLOCATION / N_LONGS
 SHORT_W = SHORT_ALLOCATION / N_SHORTS
 
 
-def build_trading_dataset():
+# -----------------------------
+# Vectorized weight engine
+# -----------------------------
+def unsafe_to_trade(days_to_vanish, holding_period=HOLDING_PERIOD):
+    """True where the ticker disappears within the next holding_period days."""
+    return (days_to_vanish >= 1) & (days_to_vanish <= holding_period)
+
+
+def future_available(prices, codes, holding_period=HOLDING_PERIOD):
+    """
+    True where the same ticker has a price on day i and on each of the next
+    HOLDING_PERIOD days. Computed for every date at once with a forward-looking
+    window sum over a cumulative count; the last HOLDING_PERIOD rows are False.
+    """
+    n_dates, n_slots = prices.shape
+    window = holding_period + 1
+    available = np.zeros((n_dates, n_slots), dtype=bool)
+    if n_dates < window:
+        return available
+
+    live = ~np.isnan(prices) & (codes >= 0)
+    counts = np.zeros((n_dates + 1, n_slots), dtype=np.int64)
+    np.cumsum(live, axis=0, out=counts[1:])
+
+    n_valid = n_dates - holding_period
+    full_window = (counts[window:] - counts[:n_valid]) == window
+
+    # Slots are reused, so the ticker at i + HOLDING_PERIOD must be the same one
+    same_ticker = codes[holding_period:] == codes[:n_valid]
+
+    available[:n_valid] = full_window & same_ticker
+    return available
+
+
+def build_weights(
+    prices,
+    signals,
+    unsafe,
+    codes,
+    holding_period=HOLDING_PERIOD,
+    n_longs=N_LONGS,
+    n_shorts=N_SHORTS,
+    long_w=LONG_W,
+    short_w=SHORT_W,
+):
+    """
+    Target weights for every rebalance date at once.
+
+    - Rebalance rows (every HOLDING_PERIOD days) are reset to 0.0
+    - Tradable = has a signal, not unsafe, and price available for the full hold
+    - Top N_LONGS signals get LONG_W, bottom N_SHORTS get SHORT_W
+      (shorts are written last, as in the original per-date loop)
+    - All other rows stay NaN (no order)
+    """
+    n_dates = prices.shape[0]
+    weights = np.full(prices.shape, np.nan)
+
+    rebalance = np.arange(0, n_dates, holding_period)
+    weights[rebalance] = 0.0
+
+    rebalance = rebalance[rebalance + holding_period < n_dates]
+    available = future_available(prices, codes, holding_period)
+
+    sig = signals[rebalance]
+    tradable = available[rebalance] & ~unsafe[rebalance] & ~np.isnan(sig)
+
+    # Ties go to the lower slot, as with the per-date sort + head
+    rows, cols = np.nonzero(smallest_k(-sig, n_longs, tradable))
+    weights[rebalance[rows], cols] = long_w
+
+    rows, cols = np.nonzero(smallest_k(sig, n_shorts, tradable))
+    weights[rebalance[rows], cols] = short_w
+
+    return weights
+
+
+def build_matrices(df: pd.DataFrame, slot_map: pd.DataFrame = None):
+    """
+    Slot-layout prices, signals and weights of a flagged frame sorted by
+    (date, signal desc). slot_map: existing assignments to extend
+    (see slot_layout.assign_slots). Returns (prices, signals, weights, slot_map).
+    """
+    # Slot layout: one column per live position instead of one per ticker
+    with span("pivot"):
+        dates = pd.DatetimeIndex(df["date"].unique())
+        slot_map = assign_slots(df, slot_map)
+        codes = slot_ticker_codes(slot_map, dates)
+
+        prices = to_slot_matrix(df, slot_map, dates, "close")
+        signals = to_slot_matrix(df, slot_map, dates, "signal")
+        # Empty cells count as vanishing tomorrow (unsafe for every horizon)
+        days = to_slot_matrix(df, slot_map, dates, "days_to_vanish_trading", fill_value=1)
+
+    with span("rebalance"):
+        weights = pd.DataFrame(
+            build_weights(
+                prices.to_numpy(),
+                signals.to_numpy(),
+                unsafe_to_trade(days.to_numpy(), HOLDING_PERIOD),
+                codes,
+                HOLDING_PERIOD,
+                N_LONGS,
+                N_SHORTS,
+                LONG_ALLOCATION / N_LONGS,
+                SHORT_ALLOCATION / N_SHORTS,
+            ),
+            index=prices.index,
+            columns=prices.columns,
+        )
+
+    return prices, signals, weights, slot_map
+
+
+def save_trading_dataset(prices, signals, weights, slot_map, weights_format=WEIGHTS_FORMAT):
+    with span("write"):
+        write_matrix(prices, OUT_PRICES)
+        write_matrix(signals, OUT_SIGNALS)
+        # Only one weights format is ever on disk, so readers can't pick up a stale copy
+        if weights_format == "events":
+            write_table(weights_to_events(weights, slot_map), OUT_WEIGHT_EVENTS)
+            remove_dataset(OUT_WEIGHTS)
+        else:
+            write_matrix(weights, OUT_WEIGHTS)
+            remove_dataset(OUT_WEIGHT_EVENTS)
+        write_table(slot_map, OUT_SLOT_MAP)
+
+
+def check_weights_format(weights_format):
+    if weights_format not in WEIGHTS_FORMATS:
+        raise ValueError(f"Unknown weights format {weights_format!r}; choose one of {WEIGHTS_FORMATS}")
+
+
+def saved_weights_format(weights_format=None) -> str:
+    """
+    Format of the saved weights: weights_format if given, else whichever
+    format is on disk (the newer one if an older build left both).
+    """
+    if weights_format is not None:
+        check_weights_format(weights_format)
+        return weights_format
+
+    paths = {"dense": matrix_path(OUT_WEIGHTS), "events": storage_path(OUT_WEIGHT_EVENTS)}
+    saved = {fmt: os.path.getmtime(path) for fmt, path in paths.items() if os.path.exists(path)}
+    if not saved:
+        raise FileNotFoundError(
+            f"No saved weights ({OUT_WEIGHTS} or {OUT_WEIGHT_EVENTS}); run build_trading_dataset.py first"
+        )
+    return max(saved, key=saved.get)
+
+
+def build_trading_dataset(df=None, save=True, weights_format=WEIGHTS_FORMAT):
+    """
+    Build slot-layout prices, signals and weights from the flagged dataset
+    (loaded from INPUT_FILE if df is None). weights_format picks how the
+    weights are saved (the returned weights are always the dense matrix).
+    Returns (prices, signals, weights, slot_map).
+    """
+    check_weights_format(weights_format)
+
     print(
         f"Loading data... (Config: Hold {HOLDING_PERIOD} days, {N_LONGS} Longs, {N_SHORTS} Shorts)"
     )
 
-    df = pd.read_csv(INPUT_FILE, parse_dates=["date"])
-    df = df.sort_values(["date", "signal"], ascending=[True, False])
+    with span("load"):
+        if df is None:
+            df = read_table(INPUT_FILE)
+        df = df.sort_values(["date", "signal"], ascending=[True, False])
 
-    prices = df.pivot(index="date", columns="ticker", values="close")
-    signals = df.pivot(index="date", columns="ticker", values="signal")
-    unsafe = df.pivot(index="date", columns="ticker", values="unsafe_to_trade").fillna(
-        True
-    )
+    print("Building Weights with Dynamic Checks...")
+    prices, signals, weights, slot_map = build_matrices(df)
+    print(f"Slot layout: {prices.shape[0]} dates x {prices.shape[1]} slots")
 
-    # Initialize weights matrix with NaN
-    weights = pd.DataFrame(np.nan, index=prices.index, columns=prices.columns)
-    dates = prices.index.to_list()
+    if save:
+        save_trading_dataset(prices, signals, weights, slot_map, weights_format)
+    print("Done. Dataset built successfully.")
 
-    print("Building Weights with Dynamic Checks...")
+    return prices, signals, weights, slot_map
 
-    for i, date in enumerate(dates):
 
-        if i % HOLDING_PERIOD == 0:
+# -----------------------------
+# Incremental update
+# -----------------------------
+def tail_start(n_dates: int, holding_period=HOLDING_PERIOD) -> int:
+    """
+    First row whose weights can change when dates are appended to n_dates
+    dates: the last rebalance row at or before n_dates - 1 - holding_period.
+    Earlier rows already see their full holding window, and the flags of
+    their tickers stay above holding_period (safe) however many days follow.
+    """
+    return max(0, (n_dates - 1 - holding_period) // holding_period * holding_period)
 
-            # Explicitly reset this day to 0.0 (Sell unselected stocks)
-            weights.loc[date, :] = 0.0
 
-            today_signals = signals.loc[date].dropna()
-            today_unsafe = unsafe.loc[date].loc[today_signals.index]
-            tradable = today_signals[today_unsafe == False]
+def load_trading_dataset(weights_format=None):
+    """
+    Saved (prices, signals, weights, slot_map); weights as the dense matrix,
+    read in weights_format (None: the format on disk).
+    """
+    prices = read_matrix(OUT_PRICES)
+    signals = read_matrix(OUT_SIGNALS)
+    if saved_weights_format(weights_format) == "events":
+        weights = events_to_weights(read_table(OUT_WEIGHT_EVENTS), prices.index, prices.shape[1])
+    else:
+        weights = read_matrix(OUT_WEIGHTS)
+    for matrix in (prices, signals, weights):
+        matrix.columns = matrix.columns.astype(int)
+    return prices, signals, weights, read_table(OUT_SLOT_MAP)
 
-            # Check if we have enough future data left
-            if i + HOLDING_PERIOD < len(dates):
 
-                valid_mask = pd.Series(True, index=tradable.index)
+def update_trading_dataset(flagged_tail: pd.DataFrame, save=True, weights_format=WEIGHTS_FORMAT):
+    """
+    Incremental build: only rows from tail_start() of the saved dataset on
+    are rebuilt, from flagged_tail (the flagged rows from that row's date
+    on, including the appended dates); earlier rows are kept as they are.
+    Gives the same matrices and slot map as a full build.
+    Returns (prices, signals, weights, slot_map).
+    """
+    check_weights_format(weights_format)
 
-                for offset in range(HOLDING_PERIOD + 1):
-                    future_date = dates[i + offset]
-                    price_series = prices.loc[future_date]
-                    valid_mask = valid_mask & price_series[tradable.index].notna()
+    with span("load"):
+        old = load_trading_dataset()
+    start = tail_start(len(old[0]))
+    since = old[0].index[start]
 
-                # Filter tradable list using the final mask
-                tradable = tradable.loc[valid_mask[valid_mask].index]
+    df = flagged_tail[flagged_tail["date"] >= since]
+    if df.empty or df["date"].min() != since:
+        raise ValueError(f"flagged_tail must hold every flagged row from {since.date()} on")
+    df = df.sort_values(["date", "signal"], ascending=[True, False])
 
-            else:
-                tradable = tradable.iloc[0:0]
+    *tail, slot_map = build_matrices(df, old[3])
+    n_slots = tail[0].shape[1]
 
-            longs = tradable.sort_values(ascending=False).head(N_LONGS).index
-            shorts = tradable.sort_values(ascending=True).head(N_SHORTS).index
+    prices, signals, weights = (
+        pd.concat([matrix.iloc[:start].reindex(columns=range(n_slots)), rebuilt])
+        for matrix, rebuilt in zip(old[:3], tail)
+    )
+    print(f"Rebuilt {len(tail[0])} of {len(prices)} dates from {since.date()}")
 
-            for t in longs:
-                weights.loc[date, t] = LONG_W
-            for t in shorts:
-                weights.loc[date, t] = SHORT_W
+    if save:
+        save_trading_dataset(prices, signals, weights, slot_map, weights_format)
 
-    prices.to_csv(OUT_PRICES)
-    weights.to_csv(OUT_WEIGHTS)
-    print("Done. Dataset built successfully.")
+    return prices, signals, weights, slot_map
 
 
 if __name__ == "__main__":
-    build_trading_dataset()
+    parser = argparse.ArgumentParser(description="Build the slot-layout trading dataset")
+    parser.add_argument("--weights-format", choices=WEIGHTS_FORMATS, default=WEIGHTS_FORMAT)
+    args = parser.parse_args()
+
+    build_trading_dataset(weights_format=args.weights_format)
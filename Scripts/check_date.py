@@ -1,11 +1,11 @@
 """
 validate_dataset.py
 
-Validation script for synthetic_raw.csv
+Validation script for synthetic_raw
 Checks:
 - No missing values
 - No duplicate (date, ticker)
-- Always 50 tickers per day
+- Always CONFIG.universe_size (default 50) tickers per day
 - Prices must be positive
 - AR(1) behavior check
 - Correct vanish behavior:
@@ -13,23 +13,71 @@ Checks:
     * no ticker reappears after its LAST date
     * NO requirement to appear before its first date (important!)
     * NO false gaps for replacement tickers
-- Sorted by signal each day
+- Sorted by signal each day (every date)
+
+All checks are vectorized: tickers and dates become integer codes, dates
+become business-day ordinals, and gaps / reappearances / per-day counts are
+grouped min/max/count comparisons instead of per-ticker loops. Rows with a
+null ticker or date fail the missing-values check and are left out of the
+per-day counts, spans and sorting (as groupby / nunique skip them).
 """
 
 import pandas as pd
 import numpy as np
 
-FILE_PATH = "data/synthetic_raw.csv"
+from config import CONFIG
+from storage import read_table
+
+FILE_PATH = "data/synthetic_raw"
+MAX_ERRORS_SHOWN = 10
+
+
+# -----------------------------
+# Vectorized helpers
+# -----------------------------
+def business_day_ordinals(dates: pd.DatetimeIndex) -> np.ndarray:
+    """Integer business-day number of every date (consecutive bdays differ by 1)."""
+    days = dates.to_numpy().astype("datetime64[D]")
+    return np.busday_count(np.datetime64("1970-01-01", "D"), days, weekmask="1111100")
+
 
+def ticker_spans(codes, ordinals, positions) -> pd.DataFrame:
+    """Per ticker: row count and min/max business-day ordinal and calendar position."""
+    frame = pd.DataFrame({"code": codes, "bday": ordinals, "pos": positions})
+    spans = frame.groupby("code", sort=False).agg(
+        rows=("bday", "size"),
+        first_bday=("bday", "min"),
+        last_bday=("bday", "max"),
+        first_pos=("pos", "min"),
+        last_pos=("pos", "max"),
+    )
+    return spans
 
-def validate_dataset():
 
-    print("Loading dataset...")
-    df = pd.read_csv(FILE_PATH, parse_dates=["date"])
+def report_tickers(message: str, tickers):
+    for ticker in tickers[:MAX_ERRORS_SHOWN]:
+        print(f"ERROR: Ticker {ticker} {message}")
+    if len(tickers) > MAX_ERRORS_SHOWN:
+        print(f"... and {len(tickers) - MAX_ERRORS_SHOWN} more")
+
+
+def validate_dataset(df=None):
+    """Validate df (loaded from FILE_PATH if None); returns {check: passed}."""
+
+    if df is None:
+        print("Loading dataset...")
+        df = read_table(FILE_PATH)
     print("Loaded:", len(df), "rows\n")
 
     results = {}
 
+    # Integer keys used by every check below (-1 = null ticker / NaT date)
+    ticker_codes = df["ticker"].astype("category").cat.codes.to_numpy()
+    tickers = df["ticker"].astype("category").cat.categories
+    date_codes, calendar = pd.factorize(df["date"], sort=True)
+    keyed = (ticker_codes >= 0) & (date_codes >= 0)
+    ordinals = business_day_ordinals(calendar)[date_codes]
+
     # -----------------------------------------
     # 1. Missing values
     # -----------------------------------------
@@ -42,16 +90,25 @@ def validate_dataset():
     # 2. Duplicate (date, ticker)
     # -----------------------------------------
     print("Checking duplicate rows...")
-    dup = df.duplicated(subset=["date", "ticker"]).sum()
+    # Nulls get their own code, so they only match each other (as in duplicated())
+    ticker_key = np.where(ticker_codes >= 0, ticker_codes, len(tickers))
+    date_key = np.where(date_codes >= 0, date_codes, len(calendar)).astype(np.int64)
+    key = date_key * (len(tickers) + 1) + ticker_key
+    duplicated = pd.Series(key).duplicated().to_numpy()
+    dup = duplicated.sum()
     results["duplicates"] = dup == 0
     print("Duplicate (date,ticker):", dup, "\n")
 
     # -----------------------------------------
-    # 3. Exactly 50 tickers per day
+    # 3. Exactly universe_size tickers per day
     # -----------------------------------------
-    print("Checking 50 tickers per day...")
-    day_counts = df.groupby("date")["ticker"].nunique()
-    results["50_per_day"] = (day_counts == 50).all()
+    universe_size = CONFIG.universe_size
+    print(f"Checking {universe_size} tickers per day...")
+    counted = keyed & ~duplicated
+    day_counts = pd.Series(
+        np.bincount(date_codes[counted], minlength=len(calendar)), index=calendar
+    )
+    results["universe_per_day"] = (day_counts == universe_size).all()
     print(day_counts.value_counts(), "\n")
 
     # -----------------------------------------
@@ -66,8 +123,8 @@ def validate_dataset():
     # 5. AR(1) autocorrelation check
     # -----------------------------------------
     print("Checking AR(1) behavior...")
-    sample = df["ticker"].unique()[0]
-    series = df[df["ticker"] == sample]["signal"]
+    sample = df["ticker"].iloc[0]
+    series = df["signal"][(ticker_codes == ticker_codes[0]) & (ticker_codes >= 0)]
     ac = series.autocorr(lag=1)
     print(f"Lag-1 autocorr for {sample}: {ac:.4f}")
     results["ar1_ok"] = -1 <= ac <= 1
@@ -79,50 +136,47 @@ def validate_dataset():
     print("Checking vanish behavior...")
 
     vanish_ok = True
-    grouped = df.groupby("ticker")["date"]
-
-    for ticker, dates in grouped:
-        d = sorted(dates)
-
-        # Compute expected continuous business days between first and last
-        expected = pd.date_range(start=d[0], end=d[-1], freq="B")
-
-        # If lengths differ → internal gap
-        if len(expected) != len(d):
-            print(f"ERROR: Ticker {ticker} has INTERNAL gap between {d[0]} and {d[-1]}")
-            vanish_ok = False
-
-        # No need to check days before first appearance → replacement stocks start late
-
-    # 6.2 No ticker reappears after its last date
-    spans = grouped.agg(["min", "max"])
+    spans = ticker_spans(ticker_codes[counted], ordinals[counted], date_codes[counted])
+
+    # 6.1 Continuous business days between first and last appearance
+    # (no need to check days before first appearance → replacement stocks start late)
+    expected = spans["last_bday"] - spans["first_bday"] + 1
+    gaps = spans.index[spans["rows"] != expected]
+    if len(gaps):
+        report_tickers("has INTERNAL gap between its first and last date", tickers[gaps])
+        vanish_ok = False
 
-    for ticker in spans.index:
-        last_date = spans.loc[ticker, "max"]
-        if len(df[(df["ticker"] == ticker) & (df["date"] > last_date)]) > 0:
-            print(f"ERROR: Ticker {ticker} reappeared after vanish!")
-            vanish_ok = False
+    # 6.2 No ticker vanishes from the trading calendar and reappears later
+    expected = spans["last_pos"] - spans["first_pos"] + 1
+    reappeared = spans.index[spans["rows"] != expected]
+    if len(reappeared):
+        report_tickers("reappeared after vanish!", tickers[reappeared])
+        vanish_ok = False
 
-    # 6.3 Universe always 50
-    if not (day_counts == 50).all():
-        print("ERROR: Universe is not always exactly 50 tickers!")
+    # 6.3 Universe always universe_size
+    if not (day_counts == universe_size).all():
+        print(f"ERROR: Universe is not always exactly {universe_size} tickers!")
         vanish_ok = False
 
     results["vanish_behavior"] = vanish_ok
     print("Vanish behavior OK:", vanish_ok, "\n")
 
     # -----------------------------------------
-    # 7. Check sorting by signal each day
+    # 7. Check sorting by signal each day (every date)
     # -----------------------------------------
     print("Checking signal sorting...")
 
-    sorted_ok = True
-    for date in df["date"].unique()[:5]:  # check first 5 days
-        sub = df[df["date"] == date]
-        if not np.all(sub["signal"].values == np.sort(sub["signal"].values)[::-1]):
-            print("ERROR: Sorting incorrect on date:", date)
-            sorted_ok = False
-            break
+    # Rows of a date in file order; signals must never increase within a date
+    order = np.argsort(date_codes, kind="stable")
+    order = order[date_codes[order] >= 0]
+    signal = df["signal"].to_numpy()[order]
+    same_date = date_codes[order][1:] == date_codes[order][:-1]
+    unsorted = same_date & (signal[1:] > signal[:-1])
+
+    sorted_ok = not unsorted.any()
+    if not sorted_ok:
+        bad_dates = np.unique(date_codes[order][1:][unsorted])
+        print(f"ERROR: Sorting incorrect on {len(bad_dates)} dates, first:", calendar[bad_dates[0]])
 
     results["signal_sorted"] = sorted_ok
     print("Signal sorting OK:", sorted_ok, "\n")
@@ -140,6 +194,8 @@ def validate_dataset():
     print("=" * 50)
     print("DATASET STATUS:", "VALID" if all(results.values()) else "INVALID")
 
+    return results
+
 
 if __name__ == "__main__":
     validate_dataset()
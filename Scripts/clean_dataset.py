@@ -1,138 +1,314 @@
 """
 clean_dataset.py
 
-Cleans the synthetic_raw.csv dataset and logs every change:
+Cleans the synthetic_raw dataset and logs every change:
 - Remove missing values
 - Remove duplicate (date,ticker)
 - Remove non-positive prices
-- Filter out days with not exactly 50 tickers
+- Filter out days with not exactly CONFIG.universe_size (default 50) tickers
 - Sort by (date, signal desc)
 - Enforce correct datatypes
-- Save cleaned output: synthetic_clean.csv
+- Save cleaned output: synthetic_clean (storage.py format)
 - Print detailed logs of all modifications
+
+All removal rules are evaluated as boolean arrays over the input in one
+fused pass; each removed row is attributed to the first rule it fails and the
+kept rows are taken once, already sorted. Every rule only looks at one date
+at a time, so the same kernel runs either on the whole frame (clean_dataset)
+or streamed over blocks of whole dates (python clean_dataset.py --stream
+[CHUNK_ROWS]): memory stays bounded by the chunk size for raw feeds larger
+than RAM. append_clean_dataset cleans only newly arrived dates and appends
+them (incremental mode, incremental.py).
 """
 
+import argparse
+
 import pandas as pd
 import numpy as np
 
-INPUT_FILE = "data/synthetic_raw.csv"
-OUTPUT_FILE = "data/synthetic_clean.csv"
-
-
-def clean_dataset():
+from config import CONFIG
+from instrumentation import span
+from storage import TableWriter, append_table, iter_table, read_table, write_table
+
+INPUT_FILE = "data/synthetic_raw"
+OUTPUT_FILE = "data/synthetic_clean"
+
+CHUNK_ROWS = 500_000  # rows read per chunk in streaming mode
+
+CHANGE_LOG_KEYS = [
+    "missing_values_removed",
+    "duplicate_rows_removed",
+    "bad_prices_removed",
+    "invalid_day_rows_removed",
+]
+
+
+# -----------------------------
+# Fused cleaning kernel (per block of whole dates)
+# -----------------------------
+def clean_mask(df: pd.DataFrame, change_log: dict) -> np.ndarray:
+    """
+    Rows to keep, from all rules evaluated as boolean arrays over df in one
+    pass. Each removed row is attributed to the first rule it fails:
+    1. any missing value (logged as missing cells, as before)
+    2. duplicate (date,ticker) among rows without missing values (first kept)
+    3. non-positive price
+    4. day without exactly CONFIG.universe_size surviving tickers
+    """
+    n = len(df)
+
+    missing = np.zeros(n, dtype=bool)
+    missing_cells = 0
+    for col in df.columns:
+        isna = df[col].isna().to_numpy()
+        missing_cells += int(isna.sum())
+        missing |= isna
+    change_log["missing_values_removed"] += missing_cells
+    keep = ~missing
+
+    # Integer keys without hashing: day number and categorical ticker code
+    day = df["date"].to_numpy().astype("datetime64[D]").astype(np.int64)
+    day -= day[keep].min() if keep.any() else 0
+    day[~keep] = 0
+    ticker = df["ticker"]
+    if not isinstance(ticker.dtype, pd.CategoricalDtype):
+        ticker = ticker.astype("category")
+    ticker_codes = ticker.cat.codes.to_numpy()
+    key = day * len(ticker.cat.categories) + ticker_codes
+
+    # Stable sort by key: every repeat of a key after its first row is a duplicate
+    candidates = np.flatnonzero(keep)
+    order = candidates[np.argsort(key[candidates], kind="stable")]
+    sorted_key = key[order]
+    dup = np.zeros(n, dtype=bool)
+    dup[order[1:][sorted_key[1:] == sorted_key[:-1]]] = True
+    change_log["duplicate_rows_removed"] += int(dup.sum())
+    keep &= ~dup
+
+    bad_price = keep & (df["close"].to_numpy() <= 0)
+    change_log["bad_prices_removed"] += int(bad_price.sum())
+    keep &= ~bad_price
+
+    # Surviving rows are unique per (date,ticker), so a count is a nunique
+    day_size = np.bincount(day[keep], minlength=day.max() + 1 if n else 0)
+    invalid_day = keep & (day_size[day] != CONFIG.universe_size)
+    change_log["invalid_day_rows_removed"] += int(invalid_day.sum())
+    keep &= ~invalid_day
+
+    return keep
+
+
+def clean_block(df: pd.DataFrame, change_log: dict) -> pd.DataFrame:
+    """
+    Steps 1-6 on a block holding every row of its dates: one mask for all
+    removals, then one take of the kept rows in (date, signal desc) order.
+    Removals are added to change_log.
+    """
+    rows = np.flatnonzero(clean_mask(df, change_log))
+
+    dates = df["date"].to_numpy()[rows]
+    signals = df["signal"].to_numpy(dtype=float)[rows]
+    rows = rows[np.lexsort((-signals, dates))]
+
+    return fix_types(df.take(rows))
+
+
+def fix_types(df: pd.DataFrame) -> pd.DataFrame:
+    """In place: ticker=category (sorted, used categories only), close/signal=float."""
+    ticker = df["ticker"]
+    if isinstance(ticker.dtype, pd.CategoricalDtype):
+        # Drop unused categories and sort them with one remap of the codes
+        codes = ticker.cat.codes.to_numpy()
+        categories = ticker.cat.categories
+        used = np.flatnonzero(np.bincount(codes, minlength=len(categories)))
+        order = categories[used].argsort()
+
+        remap = np.empty(len(categories), dtype=codes.dtype)
+        remap[used[order]] = np.arange(len(used))
+        ticker = pd.Categorical.from_codes(remap[codes], categories[used][order])
+    else:
+        ticker = ticker.astype(str).astype("category")
+
+    df["ticker"] = ticker
+    for col in ["close", "signal"]:
+        if df[col].dtype != float:
+            df[col] = df[col].astype(float)
+    return df
+
+
+def iter_date_blocks(chunks):
+    """
+    Regroup date-ordered chunks into blocks of whole dates: the rows of a
+    chunk's last date are carried over to the next chunk, so a date (and its
+    duplicates) split across a chunk boundary is always cleaned as a whole.
+    """
+    carry = None
+    last_date = None
+
+    for chunk in chunks:
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        if chunk["date"].notna().sum() == 0:
+            carry = chunk
+            continue
+
+        tail_date = chunk["date"].max()
+        tail = (chunk["date"] == tail_date).to_numpy()
+        block, carry = chunk[~tail], chunk[tail]
+
+        if last_date is not None and (block["date"] <= last_date).any():
+            raise ValueError("Streaming cleaner needs the raw dataset in date order")
+        if len(block):
+            last_date = block["date"].max()
+            yield block
+
+    if carry is not None and len(carry):
+        if last_date is not None and (carry["date"] <= last_date).any():
+            raise ValueError("Streaming cleaner needs the raw dataset in date order")
+        yield carry
+
+
+# -----------------------------
+# Logging
+# -----------------------------
+def print_summary(original_rows, final_rows, change_log, saved_path=None):
+    total_removed = original_rows - final_rows
 
     print("\n====================================")
-    print(" LOADING DATASET ")
+    print(" CLEANING SUMMARY ")
     print("====================================")
 
-    df = pd.read_csv(INPUT_FILE, parse_dates=["date"])
-    original_rows = len(df)
-
-    print(f"Loaded {original_rows} rows\n")
-    print("------------------------------------")
-
-    change_log = {}
+    print(f"Original rows   : {original_rows}")
+    print(f"Final rows      : {final_rows}")
+    print(f"Total removed   : {total_removed}\n")
 
-    # ---------------------------------------------------
-    # 1. Remove missing values
-    # ---------------------------------------------------
-    missing_before = df.isna().sum().sum()
-    df = df.dropna()
-    missing_after = df.isna().sum().sum()
+    for key, value in change_log.items():
+        print(f"{key}: {value}")
 
-    removed_missing = missing_before - missing_after
-    change_log["missing_values_removed"] = removed_missing
+    print("\n====================================")
+    print(" CLEANING COMPLETE ")
+    if saved_path is not None:
+        print(f" Saved cleaned dataset to: {saved_path}")
+    print("====================================\n")
 
-    print(f"Missing values removed: {removed_missing}")
+    if total_removed == 0:
+        print("NOTE: Dataset was already perfectly clean. No changes made.")
+    else:
+        print("NOTE: Dataset required cleaning. Changes applied successfully.")
 
-    # ---------------------------------------------------
-    # 2. Remove duplicates
-    # ---------------------------------------------------
-    dup_before = df.duplicated(subset=["date", "ticker"]).sum()
-    df = df.drop_duplicates(subset=["date", "ticker"])
-    dup_after = df.duplicated(subset=["date", "ticker"]).sum()
 
-    removed_dupes = dup_before - dup_after
-    change_log["duplicate_rows_removed"] = removed_dupes
+# -----------------------------
+# In-memory cleaner
+# -----------------------------
+def clean_dataset(df=None, save=True):
+    """Clean df (loaded from INPUT_FILE if None); returns the cleaned frame."""
 
-    print(f"Duplicate (date,ticker) removed: {removed_dupes}")
+    print("\n====================================")
+    print(" LOADING DATASET ")
+    print("====================================")
 
-    # ---------------------------------------------------
-    # 3. Remove non-positive prices
-    # ---------------------------------------------------
-    bad_price_before = (df["close"] <= 0).sum()
-    df = df[df["close"] > 0]
-    bad_price_after = (df["close"] <= 0).sum()
+    with span("load"):
+        if df is None:
+            df = read_table(INPUT_FILE)
+    original_rows = len(df)
 
-    removed_bad_prices = bad_price_before - bad_price_after
-    change_log["bad_prices_removed"] = removed_bad_prices
+    print(f"Loaded {original_rows} rows\n")
+    print("------------------------------------")
 
-    print(f"Non-positive price rows removed: {removed_bad_prices}")
+    change_log = dict.fromkeys(CHANGE_LOG_KEYS, 0)
 
     # ---------------------------------------------------
-    # 4. Ensure exactly 50 tickers per day
+    # 1-6. Missing values, duplicates, prices, universe size per day,
+    #      sort by date then signal descending, datatypes (one fused pass)
     # ---------------------------------------------------
-    day_counts = df.groupby("date")["ticker"].nunique()
-    invalid_days = day_counts[day_counts != 50].index.tolist()
-
-    invalid_rows_removed = df[
-        ~df["date"].isin(day_counts[day_counts == 50].index)
-    ].shape[0]
-
-    df = df[df["date"].isin(day_counts[day_counts == 50].index)]
-
-    change_log["invalid_day_rows_removed"] = invalid_rows_removed
+    with span("clean"):
+        df = clean_block(df, change_log)
 
+    print(f"Missing values removed: {change_log['missing_values_removed']}")
+    print(f"Duplicate (date,ticker) removed: {change_log['duplicate_rows_removed']}")
+    print(f"Non-positive price rows removed: {change_log['bad_prices_removed']}")
     print(
-        f"Rows removed from days not having exactly 50 tickers: {invalid_rows_removed}"
+        f"Rows removed from days not having exactly {CONFIG.universe_size} tickers: "
+        f"{change_log['invalid_day_rows_removed']}"
     )
-
-    # ---------------------------------------------------
-    # 5. Sort by date then signal descending
-    # ---------------------------------------------------
-    df = df.sort_values(["date", "signal"], ascending=[True, False])
     change_log["sorted"] = True
-    print("Sorted dataset by date and signal.")
-
-    # ---------------------------------------------------
-    # 6. Fix datatypes
-    # ---------------------------------------------------
-    df["ticker"] = df["ticker"].astype(str)
-    df["close"] = df["close"].astype(float)
-    df["signal"] = df["signal"].astype(float)
     change_log["datatype_fix"] = True
-
-    print("Datatypes fixed (ticker=str, close=float, signal=float).")
+    print("Sorted dataset by date and signal.")
+    print("Datatypes fixed (ticker=category, close=float, signal=float).")
 
     # ---------------------------------------------------
     # 7. Save cleaned dataset
     # ---------------------------------------------------
-    df.to_csv(OUTPUT_FILE, index=False)
-
-    final_rows = len(df)
-    total_removed = original_rows - final_rows
-
+    saved_path = None
+    if save:
+        with span("write"):
+            saved_path = write_table(df, OUTPUT_FILE, partition_by_date=True)
+
+    print_summary(original_rows, len(df), change_log, saved_path)
+
+    return df
+
+
+# -----------------------------
+# Streaming cleaner
+# -----------------------------
+def stream_clean_dataset(input_file=INPUT_FILE, output_file=OUTPUT_FILE, chunk_rows=CHUNK_ROWS):
+    """
+    Streaming mode: read input_file in chunks of chunk_rows rows, clean each
+    block of whole dates and append it to output_file. Memory is bounded by
+    the chunk size. The raw dataset must be in date order (as written by
+    generate_data.py). Returns the change log.
+    """
     print("\n====================================")
-    print(" CLEANING SUMMARY ")
+    print(" STREAMING CLEAN ")
     print("====================================")
 
-    print(f"Original rows   : {original_rows}")
-    print(f"Final rows      : {final_rows}")
-    print(f"Total removed   : {total_removed}\n")
+    change_log = dict.fromkeys(CHANGE_LOG_KEYS, 0)
+    original_rows = 0
 
-    for key, value in change_log.items():
-        print(f"{key}: {value}")
+    with TableWriter(output_file, partition_by_date=True) as writer:
+        for block in iter_date_blocks(iter_table(input_file, batch_rows=chunk_rows)):
+            original_rows += len(block)
+            writer.write(clean_block(block, change_log))
+            print(f"Cleaned {original_rows} rows, kept {writer.n_rows}", end="\r")
 
-    print("\n====================================")
-    print(" CLEANING COMPLETE ")
-    print(f" Saved cleaned dataset to: {OUTPUT_FILE}")
-    print("====================================\n")
+    change_log["sorted"] = True
+    change_log["datatype_fix"] = True
+    print()
+    print_summary(original_rows, writer.n_rows, change_log, writer.out)
+
+    return change_log
 
-    if total_removed == 0:
-        print("NOTE: Dataset was already perfectly clean. No changes made.")
-    else:
-        print("NOTE: Dataset required cleaning. Changes applied successfully.")
+
+# -----------------------------
+# Incremental append
+# -----------------------------
+def append_clean_dataset(new_raw: pd.DataFrame, output_file=OUTPUT_FILE, save=True):
+    """
+    Clean newly arrived raw dates (all after the cleaned dataset's last date)
+    and append them to output_file. Every rule looks at one date at a time,
+    so the cleaned history is never read. Returns (cleaned rows, change log).
+    """
+    change_log = dict.fromkeys(CHANGE_LOG_KEYS, 0)
+    df = clean_block(new_raw, change_log)
+    if save:
+        append_table(df, output_file)
+    return df, change_log
 
 
 if __name__ == "__main__":
-    clean_dataset()
+    parser = argparse.ArgumentParser(description="Clean the raw synthetic dataset")
+    parser.add_argument(
+        "--stream",
+        type=int,
+        nargs="?",
+        const=CHUNK_ROWS,
+        metavar="CHUNK_ROWS",
+        help=f"stream from disk in chunks of CHUNK_ROWS rows (default {CHUNK_ROWS})",
+    )
+    args = parser.parse_args()
+
+    if args.stream:
+        stream_clean_dataset(chunk_rows=args.stream)
+    else:
+        clean_dataset()
@@ -0,0 +1,78 @@
+"""
+config.py
+
+Shared pipeline configuration read by every stage.
+
+One PipelineConfig object (CONFIG) holds the settings that more than one
+stage depends on, so they are defined once instead of per script:
+- universe_size : live tickers per day (generated by generate_data.py,
+                  required per day by clean_dataset.py and check_date.py)
+- holding_period, n_longs, n_shorts, long_allocation, short_allocation :
+                  strategy settings (build_trading_dataset.py, run_backtest.py)
+- seed          : base seed of the synthetic universe
+
+Every field can be set from the environment as PIPELINE_<FIELD>, e.g.
+    PIPELINE_UNIVERSE_SIZE=5000 python pipeline.py
+or changed for a block of code:
+    with CONFIG.override(universe_size=500):
+        run_pipeline()
+
+Only RUNTIME_FIELDS can be overridden: stages read them from CONFIG at call
+time. The strategy settings and the seed are copied into module constants
+at import (build_trading_dataset.HOLDING_PERIOD, ..., generate_data.SEED),
+so they are set through the environment or passed to the stage functions.
+"""
+
+import os
+import contextlib
+from dataclasses import dataclass, fields
+
+# Fields every stage reads from CONFIG at call time (the only ones override can change)
+RUNTIME_FIELDS = ("universe_size",)
+
+
+@dataclass
+class PipelineConfig:
+    universe_size: int = 50
+    holding_period: int = 3
+    n_longs: int = 5
+    n_shorts: int = 5
+    long_allocation: float = 0.80
+    short_allocation: float = -0.20
+    seed: int = 42
+
+    @classmethod
+    def from_env(cls, prefix="PIPELINE_"):
+        """Defaults, overridden by PIPELINE_<FIELD> environment variables."""
+        values = {}
+        for field in fields(cls):
+            raw = os.environ.get(prefix + field.name.upper())
+            if raw is not None:
+                values[field.name] = field.type(raw)
+        return cls(**values)
+
+    @contextlib.contextmanager
+    def override(self, **changes):
+        """Temporarily change RUNTIME_FIELDS in place (restored on exit)."""
+        unknown = set(changes) - {field.name for field in fields(self)}
+        if unknown:
+            raise ValueError(f"Unknown config fields: {sorted(unknown)}")
+
+        frozen = set(changes) - set(RUNTIME_FIELDS)
+        if frozen:
+            raise ValueError(
+                f"Config fields {sorted(frozen)} are read at import time and cannot be "
+                f"overridden; set PIPELINE_<FIELD> in the environment or pass them explicitly"
+            )
+
+        previous = {name: getattr(self, name) for name in changes}
+        for name, value in changes.items():
+            setattr(self, name, value)
+        try:
+            yield self
+        finally:
+            for name, value in previous.items():
+                setattr(self, name, value)
+
+
+CONFIG = PipelineConfig.from_env()